@@ -3,7 +3,7 @@ import sys
 # DON'T CHANGE THIS !!!
 sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
 
-from flask import Flask, send_from_directory
+from flask import Flask, jsonify, send_from_directory
 from flask_cors import CORS
 from src.models.user import db
 from src.routes.user import user_bp
@@ -11,6 +11,8 @@ from src.routes.patent import patent_bp
 
 app = Flask(__name__, static_folder=os.path.join(os.path.dirname(__file__), 'static'))
 app.config['SECRET_KEY'] = 'asdf#FGSgvasgf$5$WGT'
+# 讓Werkzeug在接收body前就拒絕超大請求，不必先收完整個檔案
+app.config['MAX_CONTENT_LENGTH'] = 50 * 1024 * 1024  # 50MB
 
 # 啟用CORS支援
 CORS(app)
@@ -25,6 +27,10 @@ db.init_app(app)
 with app.app_context():
     db.create_all()
 
+@app.errorhandler(413)
+def request_entity_too_large(error):
+    return jsonify({'error': '檔案大小超過限制 (50MB)'}), 413
+
 @app.route('/', defaults={'path': ''})
 @app.route('/<path:path>')
 def serve(path):
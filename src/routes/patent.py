@@ -1,58 +1,136 @@
 from flask import Blueprint, jsonify, request, current_app
+import hashlib
 import os
-import tempfile
-import uuid
-import threading
+import shutil
 import time
-from werkzeug.utils import secure_filename
+import uuid
+from pathlib import Path
+from celery import Celery
+from celery.result import AsyncResult
 from flask_cors import cross_origin
 from src.services.patent_analyzer import PatentAnalyzer
+from src.services.task_store import TaskStore
 
 patent_bp = Blueprint('patent', __name__)
 
 ALLOWED_EXTENSIONS = {'pdf'}
 MAX_FILE_SIZE = 50 * 1024 * 1024  # 50MB
 
-# 儲存分析任務狀態
-analysis_tasks = {}
+# Celery任務佇列 - 以Redis作為broker與結果後端，
+# 讓分析任務可跨多個worker執行並在重啟後保留狀態
+# 共享上傳目錄 - 上傳檔案落地於此，任務只攜帶路徑，
+# 避免讓幾十MB的PDF位元組經過broker序列化
+UPLOAD_DIR = Path(os.environ.get('UPLOAD_DIR', '/var/data/patent-uploads'))
+UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
+UPLOAD_MAX_AGE = 86400  # 殘留檔案保留上限 (24小時)
+
+REDIS_URL = os.environ.get('REDIS_URL', 'redis://localhost:6379/0')
+celery = Celery('patent', broker=REDIS_URL, backend=REDIS_URL)
+celery.conf.update(
+    result_expires=86400,  # 結果後端以24小時TTL自動清除
+    # 分析是CPU-bound工作，且分析器本身不再fan-out子進程，
+    # worker數量就是唯一的平行度來源，不可超過核心數；
+    # prefetch設1讓長任務不會在單一worker上排隊
+    worker_concurrency=min(os.cpu_count() or 1, 4),
+    worker_prefetch_multiplier=1,
+)
+# 每小時清掃一次上傳目錄，確保行程崩潰時殘留的檔案也會被回收
+celery.conf.beat_schedule = {
+    'sweep-uploads': {
+        'task': 'src.routes.patent.sweep_uploads',
+        'schedule': 3600.0,
+    },
+}
+
 analyzer = PatentAnalyzer()
+task_store = TaskStore(REDIS_URL)
 
 def allowed_file(filename):
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def run_analysis(task_id, file_path, temp_dir):
-    """在背景執行分析任務"""
+@celery.task(bind=True)
+def analyze_task(self, pdf_path, content_hash):
+    """在Celery worker中執行分析任務"""
     try:
-        # 更新狀態為處理中
-        analysis_tasks[task_id]['status'] = 'processing'
-        analysis_tasks[task_id]['progress'] = 10
-        analysis_tasks[task_id]['message'] = '開始分析PDF檔案...'
-        
+        self.update_state(state='PROGRESS', meta={
+            'progress': 10,
+            'message': '開始分析PDF檔案...'
+        })
+
         # 執行分析
-        result = analyzer.analyze_patent_pdf(file_path)
-        
-        # 更新進度
-        analysis_tasks[task_id]['progress'] = 90
-        analysis_tasks[task_id]['message'] = '生成分析報告...'
-        
-        # 儲存結果
-        analysis_tasks[task_id]['status'] = 'completed'
-        analysis_tasks[task_id]['progress'] = 100
-        analysis_tasks[task_id]['message'] = '分析完成'
-        analysis_tasks[task_id]['result'] = result
-        
-        # 清理檔案
+        result = analyzer.analyze_patent_pdf(Path(pdf_path).read_bytes())
+
+        self.update_state(state='PROGRESS', meta={
+            'progress': 90,
+            'message': '生成分析報告...'
+        })
+
+        # 快取結果，相同內容的PDF再次上傳時不必重跑分析；
+        # 只快取真正解析出內容的結果，避免空結果污染快取7天
+        if result['pages_processed'] > 0:
+            task_store.cache_result(content_hash, result)
+
+        return result
+
+    finally:
+        # 清理上傳檔案；失敗時由sweep_uploads兜底
+        Path(pdf_path).unlink(missing_ok=True)
+
+@celery.task
+def sweep_uploads():
+    """定期清掃上傳目錄，刪除超過保留期限的殘留檔案"""
+    now = time.time()
+    for path in UPLOAD_DIR.iterdir():
         try:
-            os.remove(file_path)
-            os.rmdir(temp_dir)
-        except:
-            pass
-            
-    except Exception as e:
-        analysis_tasks[task_id]['status'] = 'failed'
-        analysis_tasks[task_id]['message'] = f'分析失敗: {str(e)}'
-        analysis_tasks[task_id]['error'] = str(e)
+            if now - path.stat().st_mtime > UPLOAD_MAX_AGE:
+                if path.is_dir():
+                    shutil.rmtree(path, ignore_errors=True)
+                else:
+                    path.unlink(missing_ok=True)
+        except OSError:
+            continue
+
+def _task_snapshot(task_id, meta):
+    """讀取結果快取與Celery結果後端，轉換為API使用的狀態格式"""
+    # 內容雜湊命中快取時直接回傳完成狀態，不經過Celery後端
+    content_hash = meta.get('content_hash')
+    if content_hash:
+        cached = task_store.get_cached_result(content_hash)
+        if cached is not None:
+            return {
+                'status': 'completed',
+                'progress': 100,
+                'message': '分析完成',
+                'result': cached
+            }
+
+    async_result = AsyncResult(task_id, app=celery)
+
+    if async_result.state == 'PENDING':
+        return {'status': 'pending', 'progress': 0, 'message': '等待處理...'}
+    elif async_result.state in ('STARTED', 'PROGRESS'):
+        info = async_result.info if isinstance(async_result.info, dict) else {}
+        return {
+            'status': 'processing',
+            'progress': info.get('progress', 0),
+            'message': info.get('message', '處理中...')
+        }
+    elif async_result.state == 'SUCCESS':
+        return {
+            'status': 'completed',
+            'progress': 100,
+            'message': '分析完成',
+            'result': async_result.result
+        }
+    else:  # FAILURE / REVOKED
+        error = str(async_result.info) if async_result.info else '未知錯誤'
+        return {
+            'status': 'failed',
+            'progress': 0,
+            'message': f'分析失敗: {error}',
+            'error': error
+        }
 
 @patent_bp.route('/upload', methods=['POST'])
 @cross_origin()
@@ -61,59 +139,55 @@ def upload_patent():
     上傳專利PDF檔案並開始分析
     """
     try:
+        # Content-Length已超限就直接拒絕，不讀取body
+        # (MAX_CONTENT_LENGTH讓Werkzeug對未宣告長度的請求把關)
+        if request.content_length and request.content_length > MAX_FILE_SIZE:
+            return jsonify({'error': '檔案大小超過限制 (50MB)'}), 413
+
         # 檢查是否有檔案
         if 'file' not in request.files:
             return jsonify({'error': '沒有檔案被上傳'}), 400
-        
+
         file = request.files['file']
-        
+
         # 檢查檔案名稱
         if file.filename == '':
             return jsonify({'error': '沒有選擇檔案'}), 400
-        
+
         # 檢查檔案類型
         if file and allowed_file(file.filename):
-            # 生成唯一的檔案名稱和任務ID
+            # 直接讀進記憶體，不經過磁碟
+            pdf_bytes = file.read()
+
+            # 以內容雜湊檢查快取，同一份PDF重複上傳不必重跑分析
+            content_hash = hashlib.sha256(pdf_bytes).hexdigest()
             task_id = str(uuid.uuid4())
-            unique_filename = str(uuid.uuid4()) + '.pdf'
-            
-            # 建立臨時目錄
-            temp_dir = tempfile.mkdtemp()
-            file_path = os.path.join(temp_dir, unique_filename)
-            
-            # 儲存檔案
-            file.save(file_path)
-            
-            # 檢查檔案大小
-            file_size = os.path.getsize(file_path)
-            if file_size > MAX_FILE_SIZE:
-                os.remove(file_path)
-                os.rmdir(temp_dir)
-                return jsonify({'error': '檔案大小超過限制 (50MB)'}), 400
-            
-            # 初始化任務狀態
-            analysis_tasks[task_id] = {
-                'status': 'pending',
-                'progress': 0,
-                'message': '等待處理...',
-                'filename': file.filename,
-                'created_at': time.time()
-            }
-            
-            # 在背景執行分析
-            thread = threading.Thread(target=run_analysis, args=(task_id, file_path, temp_dir))
-            thread.daemon = True
-            thread.start()
-            
+
+            if task_store.get_cached_result(content_hash) is None:
+                # 落地到共享上傳目錄，任務只攜帶路徑
+                pdf_path = UPLOAD_DIR / f'{task_id}.pdf'
+                pdf_path.write_bytes(pdf_bytes)
+
+                # 將分析任務送進Celery佇列
+                analyze_task.apply_async(args=[str(pdf_path), content_hash],
+                                         task_id=task_id)
+
+            # 記錄任務中繼資料 (帶TTL，過期自動清除)；
+            # 快取命中時不派發任務，狀態端點會直接以雜湊取回結果
+            task_store.set(task_id,
+                           filename=file.filename,
+                           created_at=time.time(),
+                           content_hash=content_hash)
+
             return jsonify({
                 'message': '檔案上傳成功，開始分析',
                 'task_id': task_id,
                 'filename': file.filename
             }), 200
-        
+
         else:
             return jsonify({'error': '不支援的檔案格式，請上傳PDF檔案'}), 400
-            
+
     except Exception as e:
         return jsonify({'error': f'上傳失敗: {str(e)}'}), 500
 
@@ -124,11 +198,12 @@ def get_analysis_result(task_id):
     取得專利分析結果
     """
     try:
-        if task_id not in analysis_tasks:
+        meta = task_store.get(task_id)
+        if not meta:
             return jsonify({'error': '找不到指定的分析任務'}), 404
-        
-        task = analysis_tasks[task_id]
-        
+
+        task = _task_snapshot(task_id, meta)
+
         if task['status'] == 'completed':
             return jsonify({
                 'task_id': task_id,
@@ -148,7 +223,7 @@ def get_analysis_result(task_id):
                 'progress': task['progress'],
                 'message': task['message']
             }), 202  # 202 Accepted - 仍在處理中
-        
+
     except Exception as e:
         return jsonify({'error': f'取得結果失敗: {str(e)}'}), 500
 
@@ -157,22 +232,34 @@ def get_analysis_result(task_id):
 def get_analysis_status(task_id):
     """
     取得分析狀態
+
+    支援 ETag / If-None-Match：狀態未變時回傳無內容的304，
+    前端輪詢時收到304可逐步拉長輪詢間隔 (例如加倍至5秒上限)
     """
     try:
-        if task_id not in analysis_tasks:
+        meta = task_store.get(task_id)
+        if not meta:
             return jsonify({'error': '找不到指定的分析任務'}), 404
-        
-        task = analysis_tasks[task_id]
-        
-        return jsonify({
+
+        task = _task_snapshot(task_id, meta)
+
+        # 以 (status, progress) 計算弱ETag，狀態沒變就不用重傳JSON
+        etag = hashlib.md5(f"{task['status']}:{task['progress']}".encode()).hexdigest()
+        if request.headers.get('If-None-Match') == etag:
+            return '', 304
+
+        response = jsonify({
             'task_id': task_id,
             'status': task['status'],
             'progress': task['progress'],
             'message': task['message'],
-            'filename': task.get('filename', ''),
-            'created_at': task.get('created_at', 0)
-        }), 200
-        
+            'filename': meta.get('filename', ''),
+            'created_at': float(meta.get('created_at', 0))
+        })
+        response.headers['ETag'] = etag
+        response.headers['Cache-Control'] = 'no-cache, must-revalidate'
+        return response, 200
+
     except Exception as e:
         return jsonify({'error': f'狀態查詢失敗: {str(e)}'}), 500
 
@@ -183,21 +270,22 @@ def generate_report(task_id):
     生成完整的專利分析報告
     """
     try:
-        if task_id not in analysis_tasks:
+        meta = task_store.get(task_id)
+        if not meta:
             return jsonify({'error': '找不到指定的分析任務'}), 404
-        
-        task = analysis_tasks[task_id]
-        
+
+        task = _task_snapshot(task_id, meta)
+
         if task['status'] != 'completed':
             return jsonify({'error': '分析尚未完成，無法生成報告'}), 400
-        
+
         result = task['result']
-        
+
         # 生成詳細報告
         report_data = {
             'task_id': task_id,
             'report_title': '專利分析報告',
-            'filename': task.get('filename', '未知檔案'),
+            'filename': meta.get('filename', '未知檔案'),
             'generated_at': time.strftime('%Y-%m-%d %H:%M:%S'),
             'executive_summary': f"本專利共識別出 {len(result['chemical_formulas'])} 個化學式和 {len(result['smiles_structures'])} 個化學結構，分析了 {result['pages_processed']} 頁內容。",
             'detailed_analysis': {
@@ -220,9 +308,8 @@ def generate_report(task_id):
                 '評估商業化可行性和市場潛力'
             ]
         }
-        
+
         return jsonify(report_data), 200
-        
+
     except Exception as e:
         return jsonify({'error': f'報告生成失敗: {str(e)}'}), 500
-
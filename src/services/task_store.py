@@ -0,0 +1,45 @@
+import json
+import os
+import redis
+
+class TaskStore:
+    """
+    任務中繼資料儲存 - 以Redis hash保存任務的附加欄位
+
+    Celery結果後端只保存任務狀態與回傳值，檔名與建立時間等中繼資料
+    存放在這裡，讓任何gunicorn worker都查得到。每個key都帶TTL，
+    過期自動清除，記憶體用量有上限且不需排程清理
+    """
+
+    TTL_SECONDS = 86400  # 24小時
+    RESULT_TTL_SECONDS = 7 * 86400  # 相同PDF的分析結果快取7天
+
+    def __init__(self, redis_url: str = None):
+        redis_url = redis_url or os.environ.get('REDIS_URL', 'redis://localhost:6379/0')
+        pool = redis.ConnectionPool.from_url(redis_url, decode_responses=True)
+        self._redis = redis.Redis(connection_pool=pool)
+
+    def _key(self, task_id: str) -> str:
+        return f'task:{task_id}'
+
+    def set(self, task_id: str, **fields) -> None:
+        """寫入欄位並重設TTL (pipeline一次往返)"""
+        pipe = self._redis.pipeline()
+        pipe.hset(self._key(task_id), mapping=fields)
+        pipe.expire(self._key(task_id), self.TTL_SECONDS)
+        pipe.execute()
+
+    def get(self, task_id: str) -> dict:
+        """讀取任務的所有欄位，不存在時回傳空dict"""
+        return self._redis.hgetall(self._key(task_id))
+
+    def get_cached_result(self, content_hash: str):
+        """依PDF內容雜湊讀取快取的分析結果，沒有快取時回傳None"""
+        cached = self._redis.get(f'result:{content_hash}')
+        return json.loads(cached) if cached else None
+
+    def cache_result(self, content_hash: str, result: dict) -> None:
+        """以PDF內容雜湊為key快取分析結果"""
+        self._redis.setex(f'result:{content_hash}',
+                          self.RESULT_TTL_SECONDS,
+                          json.dumps(result))